@@ -1,4 +1,6 @@
 const URL = "ws://localhost:9083";
+// first byte of a binary frame from the server, followed by raw PCM
+const AUDIO_FRAME_TAG = 0x01;
 const video = document.getElementById("videoElement");
 const canvas = document.getElementById("canvasElement");
 let context;
@@ -83,6 +85,7 @@ function connect() {
 	console.log("Attempting to connect to:", URL);
 
 	webSocket = new WebSocket(URL);
+	webSocket.binaryType = "arraybuffer";
 
 	webSocket.onopen = (event) => {
 		console.log("WebSocket connection established");
@@ -157,15 +160,20 @@ function sendVoiceMessage(b64PCM) {
 }
 
 function receiveMessage(event) {
+	if (event.data instanceof ArrayBuffer) {
+		const tag = new Uint8Array(event.data, 0, 1)[0];
+		if (tag === AUDIO_FRAME_TAG) {
+			injestAudioChuckToPlay(event.data.slice(1));
+		}
+		return;
+	}
+
 	const messageData = JSON.parse(event.data);
 	const response = new Response(messageData);
 
 	if (response.text) {
 		displayMessage(`GEMINI: ${response.text}`);
 	}
-	if (response.audioData) {
-		injestAudioChuckToPlay(response.audioData);
-	}
 }
 
 async function initializeAudioContext() {
@@ -182,15 +190,6 @@ async function initializeAudioContext() {
 	initialized = true;
 }
 
-function base64ToArrayBuffer(base64) {
-	const binaryString = window.atob(base64);
-	const bytes = new Uint8Array(binaryString.length);
-	for (let i = 0; i < binaryString.length; i++) {
-		bytes[i] = binaryString.charCodeAt(i);
-	}
-	return bytes.buffer;
-}
-
 function convertPCM16LEToFloat32(pcmData) {
 	const inputArray = new Int16Array(pcmData);
 	const float32Array = new Float32Array(inputArray.length);
@@ -202,12 +201,11 @@ function convertPCM16LEToFloat32(pcmData) {
 	return float32Array;
 }
 
-async function injestAudioChuckToPlay(base64AudioChunk) {
+async function injestAudioChuckToPlay(arrayBuffer) {
 	try {
 		if (audioInputContext.state === "suspended") {
 			await audioInputContext.resume();
 		}
-		const arrayBuffer = base64ToArrayBuffer(base64AudioChunk);
 		const float32Data = convertPCM16LEToFloat32(arrayBuffer);
 
 		workletNode.port.postMessage(float32Data);
@@ -288,15 +286,10 @@ stopButton.addEventListener("click", stopAudioInput);
 class Response {
 	constructor(data) {
 		this.text = null;
-		this.audioData = null;
 		this.endOfTurn = null;
 
 		if (data.text) {
 			this.text = data.text;
 		}
-
-		if (data.audio) {
-			this.audioData = data.audio;
-		}
 	}
 }
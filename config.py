@@ -1,11 +1,15 @@
 import functools
+import os
 from pathlib import Path
 
+from dotenv import dotenv_values
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 BASE_DIR = Path(__file__).resolve().parent
 DOTENV = Path(BASE_DIR, ".env")
 DOTENV_PROD = Path(BASE_DIR, "prod.env")
+# must match the strings pydantic parses as False, see `AppSettings.DEBUG`
+FALSE_VALUES = frozenset(("0", "off", "f", "false", "n", "no"))
 
 
 class AppSettings(BaseSettings):
@@ -22,11 +26,16 @@ def get_app_settings() -> AppSettings:
     instead of reading it for each request. The AppSettings object will be
     created only once, the first time it's called. Then it will return
     the same object that was returned on the first call, again and again.
+
+    `DEBUG` is looked up in the environment (falling back to the `.env` file)
+    before any settings are built, so only one AppSettings is constructed.
     """
 
-    app_settings = AppSettings()
-    if app_settings.DEBUG:
-        return app_settings
+    debug = os.environ.get("DEBUG")
+    if debug is None:
+        debug = dotenv_values(DOTENV).get("DEBUG")
+    if debug is None or debug.strip().lower() not in FALSE_VALUES:
+        return AppSettings()
 
     return AppSettings(_env_file=DOTENV_PROD, _env_file_encoding="utf-8")  # pyright: ignore[reportCallIssue]
 
@@ -1,17 +1,18 @@
 import asyncio
-import base64
 import contextlib
-import io
-import json
-import wave
+import hashlib
+import struct
+from collections import OrderedDict
 from dataclasses import dataclass, field
 from typing import Any
 
 import google.generativeai as generative
+import numpy as np
+import orjson
+import uvloop
 import websockets
 from google import genai
-from pydub import AudioSegment
-from websockets.protocol import Protocol
+from websockets.protocol import Protocol, State
 
 from config import config
 from logger import setup_logger
@@ -20,11 +21,55 @@ API_KEY = config.GOOGLE_API_KEY
 MODEL = "gemini-2.0-flash-exp"
 TRANSCRIPTION_MODEL = "gemini-1.5-flash-8b"
 
+# format of the PCM audio produced by the Live API
+PCM_SAMPLE_RATE = 24000
+PCM_CHANNELS = 1
+PCM_SAMPLE_WIDTH = 2
+# inline requests are capped at 20 MB with the audio base64-encoded (4/3 larger),
+# so 15 MB of audio fits minus 64 KiB kept for the prompt, WAV header and JSON
+# envelope; larger audio is sent as MP3
+INLINE_REQUEST_LIMIT = 20_000_000
+MAX_INLINE_WAV_SIZE = INLINE_REQUEST_LIMIT * 3 // 4 - 64 * 1024
+
+# first byte of a binary frame sent to the client, followed by raw PCM
+AUDIO_FRAME_TAG = b"\x01"
+TRANSCRIPTION_CACHE_SIZE = 256
+SUPPORTED_MIME_TYPES = frozenset(("audio/pcm", "image/jpeg"))
+# how the client's JSON.stringify serializes realtime input messages
+REALTIME_INPUT_PREFIX = '{"realtime_input"'
+REALTIME_INPUT_PREFIX_BYTES = REALTIME_INPUT_PREFIX.encode()
+# turns whose 16-bit PCM RMS falls below this are treated as silence
+SILENCE_RMS_THRESHOLD = 200
+# outbound frames buffered per client before Gemini responses are held back
+SEND_QUEUE_SIZE = 32
+
+DEFAULT_SETUP_CONFIG = {
+    "generation_config": {
+        "response_modalities": ["AUDIO", "TEXT"],
+        "language": "en",
+        "temperature": 0.7,
+        "candidate_count": 1,
+    },
+    "safety_settings": {
+        "harassment": "block_none",
+        "hate_speech": "block_none",
+        "sexually_explicit": "block_none",
+        "dangerous_content": "block_none",
+    },
+}
+
+# any buffer-protocol object holding raw PCM, so callers never need to copy
+PCMBuffer = bytes | bytearray | memoryview
+
 generative.configure(api_key=API_KEY)  # pyright: ignore[reportAttributeAccessIssue, reportUnknownMemberType]
+transcription_client = generative.GenerativeModel(model_name=TRANSCRIPTION_MODEL)
 
 
 log = setup_logger(__name__)
 
+# transcripts of recent turns, keyed by a digest of their PCM audio
+_transcription_cache: OrderedDict[bytes, str] = OrderedDict()
+
 # model_list = list(generative.list_models())
 # for model in model_list:
 #     log.info(model.name)
@@ -44,29 +89,48 @@ class GeminiSession:
 
     websocket: Protocol
     session: Any
-    audio_data: bytearray = field(default_factory=bytearray)
-
-
-async def process_media_chunk(session: Any, chunk: dict) -> None:
-    """Process a single media chunk and send it to Gemini."""
-    mime_type = chunk.get("mime_type")
-    if mime_type in ("audio/pcm", "image/jpeg"):
-        await session.send(
-            {
-                "mime_type": mime_type,
-                "data": chunk["data"],
-            }
-        )
+    audio_data: list[bytes] = field(default_factory=list)
+    send_queue: asyncio.Queue[tuple[bytes, bool]] = field(
+        default_factory=lambda: asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+    )
+    transcription_tasks: set[asyncio.Task] = field(default_factory=set)
+
+
+async def process_media_chunk(session: Any, mime_type: str, data: str) -> None:
+    """Send a single media chunk to Gemini."""
+    await session.send(
+        {
+            "mime_type": mime_type,
+            "data": data,
+        }
+    )
 
 
-async def handle_client_message(session: Any, message: str) -> None:
+async def handle_client_message(session: Any, message: str | bytes) -> None:
     """Process a single message form the client."""
+    # only realtime input is forwarded, skip parsing anything else
+    prefix = (
+        REALTIME_INPUT_PREFIX
+        if isinstance(message, str)
+        else REALTIME_INPUT_PREFIX_BYTES
+    )
+    if not message.startswith(prefix):
+        return
+
     try:
-        data = json.loads(message)
-        if "realtime_input" in data:
-            for chunk in data["realtime_input"]["media_chunks"]:
-                await process_media_chunk(session, chunk)
-    except json.JSONDecodeError:
+        data = orjson.loads(message)
+        chunks = [
+            (mime_type, chunk["data"])
+            for chunk in data["realtime_input"]["media_chunks"]
+            if (mime_type := chunk.get("mime_type")) in SUPPORTED_MIME_TYPES
+        ]
+        await asyncio.gather(
+            *(
+                process_media_chunk(session, mime_type, chunk_data)
+                for mime_type, chunk_data in chunks
+            )
+        )
+    except orjson.JSONDecodeError:
         log.error("Invalid JSON in client message")
     except KeyError as exc:
         log.error(f"Missing required field in message: {exc}")
@@ -74,41 +138,72 @@ async def handle_client_message(session: Any, message: str) -> None:
         log.error(f"Error processing client message: {exc}")
 
 
-async def send_to_client(websocket: Protocol, data: dict) -> None:
-    """Send formatted data to the client."""
-    try:
-        await websocket.send(json.dumps(data))
-    except Exception as exc:
-        log.error(f"Error sending to client: {exc}")
+async def queue_for_client(
+    gemini_session: GeminiSession, message: bytes, text: bool
+) -> None:
+    """Queue a frame for the client, dropping it once the connection is closed."""
+    if gemini_session.websocket.state is not State.OPEN:
+        return
+    await gemini_session.send_queue.put((message, text))
+
+
+async def send_to_client(gemini_session: GeminiSession, data: dict) -> None:
+    """Queue formatted data for the client."""
+    # orjson emits bytes, they are sent as a text frame without decoding
+    await queue_for_client(gemini_session, orjson.dumps(data), True)
+
+
+async def send_audio_to_client(
+    gemini_session: GeminiSession, audio_data: bytes
+) -> None:
+    """Queue raw audio for the client as a tagged binary frame."""
+    await queue_for_client(gemini_session, AUDIO_FRAME_TAG + audio_data, False)
 
 
 async def handle_text_part(gemini_session: GeminiSession, text: str) -> None:
     """Handle text response from Gemini."""
-    await send_to_client(gemini_session.websocket, {"text": text})
+    await send_to_client(gemini_session, {"text": text})
 
 
 async def handle_audio_part(gemini_session: GeminiSession, audio_data: bytes) -> None:
     """Handle audio response from Gemini."""
-    base64_audio = base64.b64encode(audio_data).decode("utf-8")
-    await send_to_client(gemini_session.websocket, {"audio": base64_audio})
-    gemini_session.audio_data.extend(audio_data)
+    await send_audio_to_client(gemini_session, audio_data)
+    gemini_session.audio_data.append(audio_data)
 
 
 async def handle_turn_complete(gemini_session: GeminiSession) -> None:
     """Handle turn completion and audio transcription."""
-    if gemini_session.audio_data:
-        if transcribed_text := transcribe_audio(bytes(gemini_session.audio_data)):
-            await send_to_client(gemini_session.websocket, {"text": transcribed_text})
-        gemini_session.audio_data = bytearray()
+    pcm_data = b"".join(gemini_session.audio_data)
+    gemini_session.audio_data.clear()
+    if not is_silent(pcm_data):
+        # transcribe in the background so the next model turn isn't held up
+        task = asyncio.create_task(send_transcription(gemini_session, pcm_data))
+        gemini_session.transcription_tasks.add(task)
+        task.add_done_callback(gemini_session.transcription_tasks.discard)
+
+
+async def send_transcription(gemini_session: GeminiSession, pcm_data: bytes) -> None:
+    """Transcribe a finished turn's audio and queue the text for the client."""
+    if transcribed_text := await transcribe_audio(pcm_data):
+        await send_to_client(gemini_session, {"text": transcribed_text})
 
 
 async def handle_model_turn(gemini_session: GeminiSession, model_turn: Any) -> None:
-    """Process a model turn and its parts."""
+    """Process a model turn, sending its parts to the client in one batch."""
+    texts: list[str] = []
+    audios: list[bytes] = []
     for part in model_turn.parts:
-        if hasattr(part, "text") and part.text:
-            await handle_text_part(gemini_session, part.text)
-        elif hasattr(part, "inline_data") and part.inline_data.data:
-            await handle_audio_part(gemini_session, part.inline_data.data)
+        if text := getattr(part, "text", None):
+            texts.append(text)
+        elif (inline_data := getattr(part, "inline_data", None)) and (
+            audio_data := inline_data.data
+        ):
+            audios.append(audio_data)
+
+    if texts:
+        await handle_text_part(gemini_session, "".join(texts))
+    if audios:
+        await handle_audio_part(gemini_session, b"".join(audios))
 
 
 async def gemini_to_client_loop(gemini_session: GeminiSession) -> None:
@@ -116,16 +211,15 @@ async def gemini_to_client_loop(gemini_session: GeminiSession) -> None:
     try:
         while True:
             async for response in gemini_session.session.receive():
-                if not response.server_content:
+                server_content = response.server_content
+                if not server_content:
                     log.warning(f"Unhandled server message: {response}")
                     continue
 
-                if response.server_content.model_turn:
-                    await handle_model_turn(
-                        gemini_session, response.server_content.model_turn
-                    )
+                if model_turn := server_content.model_turn:
+                    await handle_model_turn(gemini_session, model_turn)
 
-                if response.server_content.turn_complete:
+                if server_content.turn_complete:
                     await handle_turn_complete(gemini_session)
 
     except websockets.exceptions.ConnectionClosedOK:
@@ -137,6 +231,25 @@ async def gemini_to_client_loop(gemini_session: GeminiSession) -> None:
         log.info("Gemini-to-client loop terminated")
 
 
+async def client_sender_loop(gemini_session: GeminiSession) -> None:
+    """Send queued messages to the client."""
+    try:
+        while True:
+            message, text = await gemini_session.send_queue.get()
+            try:
+                await gemini_session.websocket.send(message, text=text)
+            except websockets.exceptions.ConnectionClosed:
+                raise
+            except Exception as exc:
+                log.error(f"Error sending to client: {exc}")
+    except websockets.exceptions.ConnectionClosedOK:
+        log.info("Client connection closed normally")
+    except Exception as exc:
+        log.error(f"Error in client sender loop: {exc}")
+    finally:
+        log.info("Client sender loop terminated")
+
+
 async def client_to_gemini_loop(gemini_session: GeminiSession) -> None:
     """Handle messages from client to Gemini."""
     try:
@@ -156,31 +269,18 @@ async def client_to_gemini_loop(gemini_session: GeminiSession) -> None:
 async def gemini_session_handler(
     client_websocket: Protocol,
 ) -> None:
+    gemini_session = None
     send_task = None
     receive_task = None
+    sender_task = None
 
     try:
         message = await client_websocket.recv()
         log.info(f"Received initial message: {message}")
-        config_data = json.loads(message)
-        default_config = {
-            "generation_config": {
-                "response_modalities": ["AUDIO", "TEXT"],
-                "language": "en",
-                "temperature": 0.7,
-                "candidate_count": 1,
-            },
-            "safety_settings": {
-                "harassment": "block_none",
-                "hate_speech": "block_none",
-                "sexually_explicit": "block_none",
-                "dangerous_content": "block_none",
-            },
-        }
-
+        config_data = orjson.loads(message)
         # get setup config from client or use defaults
         client_setup = config_data.get("setup", {})
-        config = {"setup": default_config | client_setup}
+        config = {"setup": DEFAULT_SETUP_CONFIG | client_setup}
 
         # log.info(f"Connecting to Gemini with config: {json.dumps(config, indent=2)}")
 
@@ -194,15 +294,24 @@ async def gemini_session_handler(
 
             send_task = asyncio.create_task(gemini_to_client_loop(gemini_session))
             receive_task = asyncio.create_task(client_to_gemini_loop(gemini_session))
-            await asyncio.gather(send_task, receive_task)
+            sender_task = asyncio.create_task(client_sender_loop(gemini_session))
+            # once any loop stops, e.g. on a client disconnect, end the session
+            # so a producer blocked on the full send queue can't hang it
+            await asyncio.wait(
+                (send_task, receive_task, sender_task),
+                return_when=asyncio.FIRST_COMPLETED,
+            )
 
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         log.error("Invalid configuration received")
     except Exception as exc:
         log.error(f"Session error: {exc}")
     finally:
         # clean up tasks
-        for task in (send_task, receive_task):
+        transcription_tasks = (
+            gemini_session.transcription_tasks if gemini_session else ()
+        )
+        for task in (send_task, receive_task, sender_task, *transcription_tasks):
             if task and not task.done():
                 task.cancel()
                 with contextlib.suppress(asyncio.CancelledError):
@@ -210,34 +319,50 @@ async def gemini_session_handler(
         log.info("Gemini session closed")
 
 
-def transcribe_audio(audio_data: bytes) -> str | None:
+def is_silent(pcm_data: PCMBuffer) -> bool:
+    """Checks whether 16-bit PCM audio is empty or below the silence threshold."""
+    num_samples = memoryview(pcm_data).nbytes // 2
+    samples = np.frombuffer(pcm_data, dtype=np.int16, count=num_samples)
+    if not samples.size:
+        return True
+    rms = np.sqrt(np.mean(samples.astype(np.float64) ** 2))
+    return rms < SILENCE_RMS_THRESHOLD
+
+
+async def transcribe_audio(audio_data: PCMBuffer) -> str | None:
     """Transcribes audio using Gemini 1.5 Flash."""
     try:
         if not audio_data:
             return "No audio data received."
 
-        mp3_audio_base64 = convert_pcm_to_mp3(audio_data)
-        if not mp3_audio_base64:
-            return "Audio conversion failed."
+        digest = hashlib.blake2b(audio_data, digest_size=16).digest()
+        if (cached_text := _transcription_cache.get(digest)) is not None:
+            _transcription_cache.move_to_end(digest)
+            return cached_text
 
-        transcription_client = generative.GenerativeModel(
-            model_name=TRANSCRIPTION_MODEL
-        )
+        if memoryview(audio_data).nbytes <= MAX_INLINE_WAV_SIZE:
+            audio_part = {
+                "mime_type": "audio/wav",
+                "data": _pcm_to_wav_bytes(audio_data),
+            }
+        else:
+            mp3_bytes = await _pcm_to_mp3_bytes(audio_data)
+            if not mp3_bytes:
+                return "Audio conversion failed."
+            audio_part = {"mime_type": "audio/mp3", "data": mp3_bytes}
 
         prompt = """Generate a transcript of the speech.
         Please do not include any other text in the response.
         If you cannot hear the speech, please only say '<Not recognizable>'."""
 
-        response = transcription_client.generate_content(
-            [
-                prompt,
-                {
-                    "mime_type": "audio/mp3",
-                    "data": base64.b64decode(mp3_audio_base64),
-                },
-            ]
+        response = await transcription_client.generate_content_async(
+            [prompt, audio_part]
         )
 
+        _transcription_cache[digest] = response.text
+        if len(_transcription_cache) > TRANSCRIPTION_CACHE_SIZE:
+            _transcription_cache.popitem(last=False)
+
         return response.text
 
     except Exception as exc:
@@ -245,22 +370,51 @@ def transcribe_audio(audio_data: bytes) -> str | None:
         return None
 
 
-def convert_pcm_to_mp3(pcm_data: bytes) -> str | None:
-    """Converts PCM audio to base64 encoded MP3."""
+def _pcm_to_wav_bytes(pcm_data: PCMBuffer) -> bytes:
+    """Wraps raw PCM audio in a 44-byte RIFF/WAV header."""
+    data_size = memoryview(pcm_data).nbytes
+    block_align = PCM_CHANNELS * PCM_SAMPLE_WIDTH
+    header = struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF",
+        36 + data_size,
+        b"WAVE",
+        b"fmt ",
+        16,  # fmt chunk size
+        1,  # PCM
+        PCM_CHANNELS,
+        PCM_SAMPLE_RATE,
+        PCM_SAMPLE_RATE * block_align,  # byte rate
+        block_align,
+        PCM_SAMPLE_WIDTH * 8,  # bits per sample
+        b"data",
+        data_size,
+    )
+    return header + pcm_data
+
+
+async def _pcm_to_mp3_bytes(pcm_data: PCMBuffer) -> bytes | None:
+    """Converts raw PCM audio to MP3 by piping it through ffmpeg."""
     try:
-        # create a WAV in memory first
-        wav_buffer = io.BytesIO()
-        with wave.open(wav_buffer, "wb") as wav_file:
-            wav_file.setnchannels(1)  # mono
-            wav_file.setsampwidth(2)  # 16-bit
-            wav_file.setframerate(24000)  # 24kHz
-            wav_file.writeframes(pcm_data)
-
-        wav_buffer.seek(0)
-        audio_segment = AudioSegment.from_wav(wav_buffer)
-        mp3_buffer = io.BytesIO()
-        audio_segment.export(mp3_buffer, format="mp3", codec="libmp3lame")
-        return base64.b64encode(mp3_buffer.getvalue()).decode("utf-8")
+        proc = await asyncio.create_subprocess_exec(
+            "ffmpeg",
+            "-loglevel", "quiet",
+            "-f", "s16le",  # 16-bit little-endian
+            "-ar", str(PCM_SAMPLE_RATE),
+            "-ac", str(PCM_CHANNELS),
+            "-i", "pipe:0",
+            "-f", "mp3",
+            "-codec:a", "libmp3lame",
+            "-b:a", "64k",
+            "pipe:1",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+        )  # fmt: skip
+        mp3_data, _ = await proc.communicate(pcm_data)
+        if proc.returncode != 0:
+            log.error(f"ffmpeg exited with code {proc.returncode}")
+            return None
+        return mp3_data
 
     except Exception as exc:
         log.error(f"Error converting PCM to MP3: {exc}")
@@ -268,10 +422,15 @@ def convert_pcm_to_mp3(pcm_data: bytes) -> str | None:
 
 
 async def main() -> None:
-    async with websockets.serve(gemini_session_handler, "localhost", 9083):
+    async with websockets.serve(
+        gemini_session_handler,
+        "localhost",
+        9083,
+        compression=None,  # payloads are base64 JPEG/PCM or raw PCM
+    ):
         log.info("Running websocket server on localhost:9083...")
         await asyncio.Future()  # running indefinitely
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    uvloop.run(main())